@@ -45,6 +45,10 @@ function pip_zip_for_lambda () {
 
 cd ${source_dir}/lambda
 
+echo "# freeze configuration of es_loader"
+cd es_loader
+python3 freeze_config.py
+cd ..
 echo "# start packing es_loader"
 pip_zip_for_lambda "es_loader"
 echo "# start packing deploy_es"
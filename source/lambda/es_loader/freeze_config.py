@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import configparser
+import hashlib
+import os
+import pickle
+
+# 後から読み込んだファイルで上書きする
+ETL_CONFIG_FILES = ('aws.ini', '/opt/user.ini', 'user.ini')
+FROZEN_ETL_CONFIG = 'etl_config.pickle'
+
+
+def read_etl_config_files():
+    etl_config = configparser.ConfigParser(
+        interpolation=configparser.ExtendedInterpolation())
+    for config_file in ETL_CONFIG_FILES:
+        etl_config.read(config_file)
+    return etl_config
+
+
+def get_config_file_digests():
+    # ini の内容が freeze した時から変わっていないかの確認に使う
+    digests = {}
+    for config_file in ETL_CONFIG_FILES:
+        if os.path.isfile(config_file):
+            with open(config_file, 'rb') as f:
+                digests[config_file] = hashlib.sha256(f.read()).hexdigest()
+        else:
+            digests[config_file] = None
+    return digests
+
+
+def freeze_etl_config(frozen_file=FROZEN_ETL_CONFIG):
+    """ini を展開済みの dict にして pickle で保存する.
+    lambda のパッケージ作成時に実行して、コールドスタート時の ini の解析を省く
+    """
+    etl_config = read_etl_config_files()
+    config_dict = {}
+    for section in etl_config:
+        # 変数(${...})は展開済みの値を保存する
+        config_dict[section] = dict(etl_config[section])
+    frozen = {'digests': get_config_file_digests(), 'config': config_dict}
+    with open(frozen_file, 'wb') as f:
+        pickle.dump(frozen, f)
+
+
+def load_frozen_etl_config(frozen_file=FROZEN_ETL_CONFIG):
+    """freeze_etl_config で保存した設定を読み込む.
+    保存したファイルがない、または ini が変更されていたら None を返すので、
+    呼び出し元で ini を読み込むこと
+    """
+    if not os.path.isfile(frozen_file):
+        return None
+    with open(frozen_file, 'rb') as f:
+        frozen = pickle.load(f)
+    if frozen['digests'] != get_config_file_digests():
+        # Lambda レイヤーの /opt/user.ini が追加された場合なども該当
+        print('INFO[{0}]: {1} is outdated. read ini files'.format(
+            os.getpid(), frozen_file))
+        return None
+    # 展開済みの値なので、値を参照する時の変数展開は不要
+    etl_config = configparser.ConfigParser(interpolation=None)
+    etl_config.read_dict(frozen['config'])
+    return etl_config
+
+
+if __name__ == '__main__':
+    freeze_etl_config()
+    print('INFO: created ' + FROZEN_ETL_CONFIG)
@@ -12,6 +12,7 @@ import boto3
 import botocore
 from elasticsearch import Elasticsearch, RequestsHttpConnection
 from requests_aws4auth import AWS4Auth
+import freeze_config
 import siem
 
 __version__ = '2.0.0'
@@ -78,12 +79,11 @@ def timestr_to_hours(timestr):
 
 
 def get_etl_config():
-    etl_config = configparser.ConfigParser(
-        interpolation=configparser.ExtendedInterpolation())
-    etl_config.read('aws.ini')
-    # overwride with user configration
-    etl_config.read('/opt/user.ini')
-    etl_config.read('user.ini')
+    # パッケージ作成時に freeze した設定があれば ini の解析を省く
+    etl_config = freeze_config.load_frozen_etl_config()
+    if etl_config is None:
+        # aws.ini を user configration で overwride する
+        etl_config = freeze_config.read_etl_config_files()
     etl_config.sections()
     if 'doc_id' not in etl_config['DEFAULT']:
         raise Exception('ERROR[{0}]: invalid config file: aws.ini. exit'
@@ -120,25 +120,30 @@ def make_not_loading_list(etl_config):
 def make_s3_session_config(etl_config):
     user_agent = etl_config['DEFAULT'].get('custom_user_agent', '')
     user_agent_ver = etl_config['DEFAULT'].get('custom_user_agent_ver', '')
+    # S3 オブジェクトをパートに分けて並列に取得するためコネクションを増やす
+    max_pool_connections = siem.S3_MAX_CONCURRENCY * 2
     if user_agent:
         s3_session_config = botocore.config.Config(
-            user_agent=f'{user_agent}/{user_agent_ver}')
+            user_agent=f'{user_agent}/{user_agent_ver}',
+            max_pool_connections=max_pool_connections)
     else:
-        s3_session_config = None
+        s3_session_config = botocore.config.Config(
+            max_pool_connections=max_pool_connections)
     return s3_session_config
 
 
 def get_es_entry(logfile, logconfig, not_loading_list):
-    # 一つのログの単位でloop
     copy_attr_list = (
-        'logtype', 'msgformat', 'file_format', 'header', 's3bucket', 's3key',
-        'accountid', 'region', 'loggroup', 'logstream')
+        'logtype', 'msgformat', 'file_format', 'header', 'header_fields',
+        's3bucket', 's3key', 'accountid', 'region', 'loggroup', 'logstream')
     logs = {}
     for key in copy_attr_list:
         logs[key] = copy.copy(getattr(logfile, key))
     log_pattern_prog = None
     if 'log_pattern' in logconfig:
         log_pattern_prog = re.compile(logconfig['log_pattern'])
+    timestamp_spec = siem.TimestampSpec(logconfig)
+    ecs_spec = siem.EcsSpec(logconfig)
     if logconfig['script_ecs']:
         mod_name = 'sf_' + logs['logtype']
         if mod_name + '.py' in user_libs:
@@ -147,36 +152,23 @@ def get_es_entry(logfile, logconfig, not_loading_list):
             sf_module = importlib.import_module('siem.' + mod_name)
     else:
         sf_module = None
-    for logdata in logfile.logdata_list:
-        # インスタンスを作ってログタイプを入れる
-        logparser = siem.LogParser(
-            logdata=logdata, logtype=logs['logtype'],
-            msgformat=logs['msgformat'], logformat=logs['file_format'],
-            header=logs['header'], logconfig=logconfig,
-            s3bucket=logs['s3bucket'], s3key=logs['s3key'],
-            accountid=logs['accountid'], region=logs['region'],
-            loggroup=logs['loggroup'], logstream=logs['logstream'],
-            log_pattern_prog=log_pattern_prog, sf_module=sf_module,)
-        # 自分自身のログを無視する。ESにはロードしない。
-        is_ignore = logparser.check_ignored_log(not_loading_list)
-        if is_ignore:
-            continue
-        # idなどの共通的なフィールドを追加する
-        logparser.add_basic_field()
-        # print('DEBUG: ID: {0}'.format(logparser.id))
-        # 同じフィールド名で複数タイプがあるとESにロードするときにエラーになるので
-        # 該当フィールドだけテキスト化する
-        logparser.clean_multi_type_field()
-        # フィールドをECSにマッピングして正規化する
-        logparser.transform_to_ecs()
-        # 一部のフィールドを修正する
-        logparser.transform_by_script()
-        # ログにgeoipなどの情報をエンリッチ
-        logparser.enrich()
-        yield {'index': {
-            '_index': logparser.indexname, '_id': logparser.index_id}}
-        # print(logparser.json)
-        yield logparser.json
+    # ログファイル毎にインスタンスを作ってログタイプを入れる
+    logparser = siem.LogParser(
+        logdata=None, logtype=logs['logtype'],
+        msgformat=logs['msgformat'], logformat=logs['file_format'],
+        header=logs['header'], header_fields=logs['header_fields'],
+        logconfig=logconfig,
+        s3bucket=logs['s3bucket'], s3key=logs['s3key'],
+        accountid=logs['accountid'], region=logs['region'],
+        loggroup=logs['loggroup'], logstream=logs['logstream'],
+        log_pattern_prog=log_pattern_prog, sf_module=sf_module,
+        timestamp_spec=timestamp_spec, ecs_spec=ecs_spec,)
+    # 一つのログの単位でloop
+    for indexname, index_id, logjson in logparser.batch(
+            logfile.logdata_list, not_loading_list):
+        yield {'index': {'_index': indexname, '_id': index_id}}
+        # print(logjson)
+        yield logjson
 
 
 def check_es_results(results):
@@ -203,6 +195,7 @@ es_hostname = get_es_hostname()
 es_conn = initialize_es_connection(es_hostname)
 user_libs = load_user_custome_libs()
 etl_config = get_etl_config()
+logtype_patterns = siem.get_logtype_patterns(etl_config)
 load_modules_on_memory(etl_config, user_libs)
 not_loading_list = make_not_loading_list(etl_config)
 s3_session_config = make_s3_session_config(etl_config)
@@ -211,10 +204,10 @@ s3_session_config = make_s3_session_config(etl_config)
 def lambda_handler(event, context):
     for record in event['Records']:
         if 'kinesis' in record:
-            logfile = siem.LogKinesis(record, etl_config)
+            logfile = siem.LogKinesis(record, etl_config, logtype_patterns)
         elif 's3' in record:
             s3 = boto3.client('s3', config=s3_session_config)
-            logfile = siem.LogS3(record, etl_config, s3)
+            logfile = siem.LogS3(record, etl_config, s3, logtype_patterns)
         else:
             raise Exception(
                 'ERROR[{0}]: invalid input data. exit'.format(os.getpid()))
@@ -225,14 +218,19 @@ def lambda_handler(event, context):
         print('INFO[{0}]: {1}'.format(os.getpid(), logfile.startmsg,))
 
         # ETL対象のログタイプのConfigだけに限定する
-        logconfig = copy.copy(etl_config[logfile.logtype])
+        logconfig = copy.copy(logfile.logconfig)
         # ESにPUTする
         size = 0
         results = False
         putdata_list = []
         for data in get_es_entry(logfile, logconfig, not_loading_list):
             putdata_list.append(data)
-            size += len(str(data))
+            if isinstance(data, str):
+                # orjson は非ASCII文字をエスケープしないので、文字数ではなく
+                # バイト数で数える
+                size += len(data.encode('utf-8'))
+            else:
+                size += len(str(data))
             # es の http.max_content_length は t2 で10MB なのでデータがたまったらESにロード
             if isinstance(data, str) and size > 6000000:
                 results = es_conn.bulk(putdata_list)
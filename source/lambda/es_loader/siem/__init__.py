@@ -4,17 +4,42 @@
 import base64
 import bz2
 import configparser
-import gzip
+import copy
 import hashlib
 import io
-import ipaddress
 import json
 import os
 import re
+import socket
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from functools import cached_property, lru_cache
+from itertools import islice
 import boto3
 import geoip2.database
+from botocore.exceptions import ClientError
+try:
+    # ISA-L で高速に gzip を展開する。インストールされていなければ標準ライブラリ
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+try:
+    # orjson で高速に JSON の文字列にする。インストールされていなければ標準ライブラリ
+    # orjson.loads は 64bit を超える整数を float にし、NaN をエラーにするので、
+    # 読み込みは標準ライブラリのままにする
+    # また、非ASCII文字はエスケープせずに UTF-8 のまま出力するので、
+    # 文字数とバイト数が一致しない
+    import orjson
+
+    def json_dumps(obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+        except orjson.JSONEncodeError:
+            # 64bit を超える整数などは標準ライブラリで文字列にする
+            return json.dumps(obj)
+except ImportError:
+    json_dumps = json.dumps
 
 __version__ = '2.0.0'
 
@@ -30,6 +55,21 @@ RE_SYSLOG_FORMAT = re.compile(r'([A-Z][a-z]{2})\s+(\d{1,2})\s+'
 MONTH_TO_INT = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
                 'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
 TD_OFFSET12 = timedelta(hours=12)
+# for conv_key and get_header_fields
+DASH_TO_UNDERSCORE = str.maketrans('-', '_')
+# ESへのLoad時にエラーとなる値
+NULL_VALUES = frozenset(('', '-', 'null'))
+# for get_mime
+MAGIC_NUMBERS = ((b'\x1f\x8b', 'gzip'), (b'\x50\x4b', 'zip'),
+                 (b'\x42\x5a', 'bzip2'))
+TEXTCHARS = bytes(
+    {7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7f})
+# 同じIPアドレスが繰り返し出現するので GeoIP の検索結果をキャッシュする。
+# 512MB の lambda で余裕をもって保持できる件数
+GEOIP_CACHE_SIZE = 16384
+# S3 オブジェクトを並列に Range GET するときのパートサイズと並列数
+S3_PART_SIZE = 8 * 1024 * 1024
+S3_MAX_CONCURRENCY = 8
 
 
 # download geoip database
@@ -74,6 +114,7 @@ if os.path.isfile('/tmp/GeoLite2-ASN.mmdb'):
     reader_geo = geoip2.database.Reader('/tmp/GeoLite2-ASN.mmdb')
 
 
+@lru_cache(maxsize=GEOIP_CACHE_SIZE)
 def get_geo_city(ip):
     try:
         response = reader_city.city(ip)
@@ -89,6 +130,7 @@ def get_geo_city(ip):
             'country_name': country_name, 'location': location}
 
 
+@lru_cache(maxsize=GEOIP_CACHE_SIZE)
 def get_geo_asn(ip):
     try:
         response = reader_geo.asn(ip)
@@ -98,21 +140,121 @@ def get_geo_asn(ip):
             'organization': {'name': response.autonomous_system_organization}}
 
 
+def is_ip(ipaddr):
+    """IPv4 か IPv6 のアドレスなら True を返す
+
+    >>> is_ip('192.0.2.1')
+    True
+    >>> is_ip('2001:db8::1')
+    True
+    >>> is_ip('example.com')
+    False
+    """
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, ipaddr)
+        except (OSError, TypeError, ValueError):
+            continue
+        return True
+    return False
+
+
 def get_mime(data):
-    if data.startswith(b'\x1f\x8b'):
-        return 'gzip'
-    elif data.startswith(b'\x50\x4b'):
-        return 'zip'
-    elif data.startswith(b'\x42\x5a'):
-        return 'bzip2'
-    textchars = bytearray(
-        {7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7f})
-    if bool(data.translate(None, textchars)):
+    for magic_number, mime in MAGIC_NUMBERS:
+        if data.startswith(magic_number):
+            return mime
+    if bool(data.translate(None, TEXTCHARS)):
         return 'binary'
     else:
         return 'text'
 
 
+def download_s3_object(s3, bucket, key, part_size=S3_PART_SIZE,
+                       concurrency=S3_MAX_CONCURRENCY):
+    """S3 オブジェクトを取得する.
+    最初のパートの Range GET でサイズを確認し、part_size より大きければ
+    残りのパートを並列に Range GET して、確保済みの bytearray に書き込む
+    取得中にオブジェクトが上書きされても別バージョンが混ざらないように、
+    残りのパートは最初のパートと同じ ETag を条件にする
+    """
+    try:
+        obj = s3.get_object(
+            Bucket=bucket, Key=key, Range=f'bytes=0-{part_size - 1}')
+    except ClientError as err:
+        if err.response['Error']['Code'] == 'InvalidRange':
+            # 0 byte のオブジェクトは Range を指定すると InvalidRange になる
+            return b''
+        raise
+    first_part = obj['Body'].read()
+    content_length = int(obj['ContentRange'].split('/')[-1])
+    if content_length <= part_size:
+        return first_part
+    etag = obj['ETag']
+    body = bytearray(content_length)
+    body[:part_size] = first_part
+
+    def get_part(start):
+        end = min(start + part_size, content_length) - 1
+        part = s3.get_object(
+            Bucket=bucket, Key=key, Range=f'bytes={start}-{end}',
+            IfMatch=etag)
+        body[start:end + 1] = part['Body'].read()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # list() で各パートの例外を呼び出し元に伝える
+        list(executor.map(
+            get_part, range(part_size, content_length, part_size)))
+    # io.BytesIO は bytearray だと毎回コピーするが、bytes なら共有するので
+    # ここで一度だけ bytes にする
+    return bytes(body)
+
+
+def get_logtype_patterns(config):
+    """config の各セクションの s3_key をコンパイルし、loggroup と合わせて返す.
+    lambda の warm start で再利用するため、config を読み込んだ時に一度だけ作成し
+    LogS3 と LogKinesis に渡す
+    """
+    return [(section, re.compile(config[section]['s3_key']),
+             config[section]['loggroup'])
+            for section in config.sections()]
+
+
+def parse_xkeys_list(xkeys_list):
+    """ dotを含んだkeyのリストを、keyのtupleのtupleに分割する。
+    数字のkeyはlistのindexとしてintにしておく
+
+    >>> parse_xkeys_list('a.b.c x.0.z')
+    (('a', 'b', 'c'), ('x', 0, 'z'))
+    """
+    paths = []
+    for xkeys in xkeys_list.split():
+        path = []
+        for k in xkeys.split('.'):
+            try:
+                k = int(k)
+            except ValueError:
+                pass
+            path.append(k)
+        paths.append(tuple(path))
+    return tuple(paths)
+
+
+def get_value_by_paths(dct, paths):
+    """ parse_xkeys_list で分割済みのkeyで値を抽出する。
+    最初に値が見つかったkeyの値を返す。値がなければ返値なし
+    """
+    for path in paths:
+        v = dct
+        for k in path:
+            try:
+                v = v[k]
+            except (TypeError, KeyError, IndexError):
+                v = ''
+                break
+        if v:
+            return v
+
+
 def get_value_from_dict(dct, xkeys_list):
     """ 入れ子になった辞書に対して、dotを含んだkeyで値を
     抽出する。keyはリスト形式で複数含んでいたら分割する。
@@ -133,89 +275,79 @@ def get_value_from_dict(dct, xkeys_list):
     >>> get_value_from_dict(dct, xkeys_list)
     123
     """
-    for xkeys in xkeys_list.split():
-        v = dct
-        for k in xkeys.split('.'):
-            try:
-                k = int(k)
-            except ValueError:
-                pass
-            try:
-                v = v[k]
-            except (TypeError, KeyError, IndexError):
-                v = ''
-                break
-        if v:
-            return v
+    return get_value_by_paths(dct, parse_xkeys_list(xkeys_list))
 
 
 def put_value_into_dict(key_str, v):
     """dictのkeyにドットが含まれている場合に入れ子になったdictを作成し、値としてvを入れる.
     返値はdictタイプ。vが辞書ならさらに入れ子として代入。
-    TODO: 値に"が入ってると例外になる。対処方法が見つからず返値なDROPPEDにしてるので改善する。#34
+    JSON文字列を経由せずに直接dictを組み立てるので、値に"が入っていても問題ない。
 
     >>> put_value_into_dict('a.b.c', 123)
     {'a': {'b': {'c': '123'}}}
     >>> v = {'x': 1, 'y': 2}
     >>> put_value_into_dict('a.b.c', v)
     {'a': {'b': {'c': {'x': 1, 'y': 2}}}}
-    >>> v = str({'x': "1", 'y': '2"3'})
-    >>> put_value_into_dict('a.b.c', v)
-    {'a': {'b': {'c': 'DROPPED'}}}
+    >>> put_value_into_dict('a.b.c', 'x"y')
+    {'a': {'b': {'c': 'x"y'}}}
     """
-    v = v
-    xkeys = key_str.split('.')
     if isinstance(v, dict):
-        json_data = r'{{"{0}": {1} }}'.format(xkeys[-1], json.dumps(v))
+        # 元のログと同じオブジェクトを共有しないようにコピーする
+        new_dict = copy.deepcopy(v)
     else:
-        json_data = r'{{"{0}": "{1}" }}'.format(xkeys[-1], v)
-    if len(xkeys) >= 2:
-        xkeys.pop()
-        for xkey in reversed(xkeys):
-            json_data = r'{{"{0}": {1} }}'.format(xkey, json_data)
-    try:
-        new_dict = json.loads(json_data, strict=False)
-    except json.decoder.JSONDecodeError:
-        new_dict = put_value_into_dict(key_str, 'DROPPED')
+        new_dict = str(v)
+    for xkey in reversed(key_str.split('.')):
+        new_dict = {xkey: new_dict}
     return new_dict
 
 
 def conv_key(obj):
     """dictのkeyに-が入ってたら_に置換する
+    es-loader 内では使っていないが、ユーザーの sf_ スクリプトから
+    使えるように残している
+
+    >>> obj = {'a-b': {'c-d': 1}, 'e': [{'f-g': 2}]}
+    >>> conv_key(obj)
+    >>> obj
+    {'e': [{'f_g': 2}], 'a_b': {'c_d': 1}}
     """
-    if isinstance(obj, dict):
-        for org_key in list(obj.keys()):
-            new_key = org_key
-            if '-' in org_key:
-                new_key = org_key.translate({ord('-'): ord('_')})
-                obj[new_key] = obj.pop(org_key)
-            conv_key(obj[new_key])
-    elif isinstance(obj, list):
-        for val in obj:
-            conv_key(val)
-    else:
-        pass
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            # ほとんどのkeyには-がないので、置換が必要なkeyだけを処理する
+            for org_key in [key for key in obj if '-' in key]:
+                obj[org_key.translate(DASH_TO_UNDERSCORE)] = obj.pop(org_key)
+            stack.extend(obj.values())
+        elif isinstance(obj, list):
+            stack.extend(obj)
+
+
+def get_header_fields(header):
+    """csv のヘッダーをフィールド名のリストにする。keyの-は_に置換する
+
+    >>> get_header_fields('version account-id interface-id')
+    ['version', 'account_id', 'interface_id']
+    """
+    return header.translate(DASH_TO_UNDERSCORE).split()
 
 
-def merge(a, b, path=None):
+def merge(a, b):
     """merges b into a
+
+    >>> merge({'a': {'b': 1, 'c': 2}}, {'a': {'c': 3}, 'd': 4})
+    {'a': {'b': 1, 'c': 3}, 'd': 4}
     """
-    if path is None:
-        path = []
-    for key in b:
-        if key in a:
-            if isinstance(a[key], dict) and isinstance(b[key], dict):
-                merge(a[key], b[key], path + [str(key)])
-            elif a[key] == b[key]:
-                pass  # same leaf value
-            elif str(a[key]) in str(b[key]):
-                # strで上書き。JSONだったのをstrに変換したデータ
-                a[key] = b[key]
+    stack = [(a, b)]
+    while stack:
+        dst, src = stack.pop()
+        for key, value in src.items():
+            dst_value = dst.get(key)
+            if isinstance(dst_value, dict) and isinstance(value, dict):
+                stack.append((dst_value, value))
             else:
                 # conflict and override original value with new one
-                a[key] = b[key]
-        else:
-            a[key] = b[key]
+                dst[key] = value
     return a
 
 
@@ -224,30 +356,51 @@ class LogObj:
     圧縮の有無の判断、ログ種類を判断、フォーマットの判断をして
     最後に、生ファイルを個々のログに分割してリスト型として返す
     """
-    def __init__(self, config):
+    def __init__(self, config, logtype_patterns=None):
         self.config = config
+        if logtype_patterns is None:
+            logtype_patterns = get_logtype_patterns(config)
+        self.logtype_patterns = logtype_patterns
         self.s3bucket = None
         self.s3key = None
         self.loggroup = None
         self.logstream = None
 
+    def get_logconfig(self):
+        # 値を参照するたびに ini の変数展開をしないように dict にしておく
+        if self.logtype in self.config:
+            return dict(self.config[self.logtype])
+        else:
+            # unknown な logtype
+            return {}
+
     @property
     def header(self):
         return None
 
+    @cached_property
+    def header_fields(self):
+        # csv のヘッダーはファイル毎に一度だけ分割する。
+        # keyの-は_に置換しておくので、ログ毎の conv_key は不要
+        if self.header:
+            return get_header_fields(self.header)
+        return None
+
 
 class LogS3(LogObj):
     """ 取得した一連のログファイルから表層的な情報を取得する。
     圧縮の有無の判断、ログ種類を判断、フォーマットの判断をして
     最後に、生ファイルを個々のログに分割してリスト型として返す
     """
-    def __init__(self, record, config, s3):
+    def __init__(self, record, config, s3, logtype_patterns=None):
         # Get the bucket name and key for the new file
-        super().__init__(config)
+        super().__init__(config, logtype_patterns)
         self.s3 = s3
         self.s3bucket = record['s3']['bucket']['name']
         self.s3key = record['s3']['object']['key']
         self.config = config
+        self.__logtype = self.get_logtype()
+        self.logconfig = self.get_logconfig()
         self.ignore = self.check_ignore()
         self.msgformat = 's3'
 
@@ -256,23 +409,25 @@ class LogS3(LogObj):
             # 対応していないlogtypeはunknownになる。その場合は処理をスキップさせる
             return f'Unknown log type in S3 key, {self.s3key}'
         else:
-            s3_key_ignored = self.config[self.logtype]['s3_key_ignored']
+            s3_key_ignored = self.logconfig['s3_key_ignored']
             if s3_key_ignored and s3_key_ignored in self.s3key:
                 return f'impossible to find logtype from S3 key, {self.s3key}'
         return False
 
-    @property
-    def logtype(self):
-        for section in self.config.sections():
-            p = self.config[section]['s3_key']
-            if re.search(p, self.s3key):
+    def get_logtype(self):
+        for section, s3_key_prog, _ in self.logtype_patterns:
+            if s3_key_prog.search(self.s3key):
                 return section
         else:
             return 'unknown'
 
+    @property
+    def logtype(self):
+        return self.__logtype
+
     @property
     def file_format(self):
-        return self.config[self.logtype]['file_format']
+        return self.logconfig['file_format']
 
     @property
     def accountid(self):
@@ -290,12 +445,14 @@ class LogS3(LogObj):
         else:
             return None
 
+    @cached_property
+    def rawbody(self):
+        # S3 からの取得は1ファイルにつき1回だけにする
+        return download_s3_object(self.s3, self.s3bucket, self.s3key)
+
     @property
     def rawdata(self):
-        obj = self.s3.get_object(Bucket=self.s3bucket, Key=self.s3key)
-        # if obj['ResponseMetadata']['HTTPHeaders']['content-length'] == '0':
-        #    raise Exception('No Contents in s3 object')
-        rawbody = io.BytesIO(obj['Body'].read())
+        rawbody = io.BytesIO(self.rawbody)
         mime = get_mime(rawbody.read(16))
         rawbody.seek(0)
         if mime == 'gzip':
@@ -313,29 +470,29 @@ class LogS3(LogObj):
             raise Exception('unknown file format')
         return body
 
-    @property
+    @cached_property
     def header(self):
         if 'csv' in self.file_format:
-            return self.rawdata.readlines()[0].strip()
+            # 先頭行だけを展開する
+            return self.rawdata.readline().strip()
         else:
             return None
 
     @property
     def logdata_list(self):
+        # 展開したログを全行リストにせず、1行ずつ読み込む
         if 'text' in self.file_format:
-            header_line_number = int(
-                self.config[self.logtype]['text_header_line_number'])
-            for logdata in self.rawdata.readlines()[header_line_number:]:
+            header_line_number = int(self.logconfig['text_header_line_number'])
+            for logdata in islice(self.rawdata, header_line_number, None):
                 yield logdata.strip()
         elif 'csv' in self.file_format:
-            for logdata in self.rawdata.readlines()[1:]:
+            for logdata in islice(self.rawdata, 1, None):
                 yield logdata.strip()
         elif 'json' in self.file_format:
-            decoder = json.JSONDecoder()
+            delimiter = self.logconfig['json_delimiter']
             # jsonl(1ファイルに1行のJSONが複数ある)を分割
-            for line in self.rawdata.readlines():
-                raw_event = decoder.decode(line)
-                delimiter = self.config[self.logtype]['json_delimiter']
+            for line in self.rawdata:
+                raw_event = json.loads(line)
                 if delimiter:
                     # 1つのJSONにログが複数ある場合
                     for record in raw_event[delimiter]:
@@ -357,21 +514,21 @@ class LogKinesis(LogObj):
     入力値となるKinesisのJSONサンプルはこちら
     https://docs.aws.amazon.com/ja_jp/lambda/latest/dg/with-kinesis-example.html
     """
-    def __init__(self, record, config):
-        super().__init__(config)
+    def __init__(self, record, config, logtype_patterns=None):
+        super().__init__(config, logtype_patterns)
         self.config = config
         self.rawdata_dict = self.get_rawdata_dict(record)
         self.loggroup = self.rawdata_dict['logGroup']
         self.logstream = self.rawdata_dict['logStream']
         self.msgformat = 'kinesis'
+        self.__logtype = self.get_logtype()
+        self.logconfig = self.get_logconfig()
         self.ignore = self.check_ignore()
         self.__file_format = None
 
     def get_rawdata_dict(self, record):
         payload = base64.b64decode(record['kinesis']['data'])
-        gzipbody = io.BytesIO(payload)
-        body = gzip.open(gzipbody, mode='rt').readline()
-        body_dict = json.loads(body)
+        body_dict = json.loads(gzip.decompress(payload))
         return body_dict
 
     def check_ignore(self):
@@ -383,21 +540,22 @@ class LogKinesis(LogObj):
         else:
             return False
 
-    @property
-    def logtype(self):
-        for section in self.config.sections():
-            if self.config[section]['loggroup'] in self.loggroup.lower():
+    def get_logtype(self):
+        loggroup = self.loggroup.lower()
+        try:
+            # CWEでログをCWLに送るとaws sourceが入ってるのでそれで評価
+            meta = self.rawdata_dict['logEvents'][0]['message'][:150].lower()
+        except (KeyError, IndexError):
+            meta = ''
+        for section, _, section_loggroup in self.logtype_patterns:
+            if section_loggroup in loggroup or section_loggroup in meta:
                 return section
-            else:
-                try:
-                    # CWEでログをCWLに送るとaws sourceが入ってるのでそれで評価
-                    meta = self.rawdata_dict['logEvents'][0]['message'][:150]
-                except KeyError:
-                    meta = ''
-                if self.config[section]['loggroup'] in meta.lower():
-                    return section
         return 'unknown'
 
+    @property
+    def logtype(self):
+        return self.__logtype
+
     @property
     def accountid(self):
         return self.rawdata_dict['owner']
@@ -419,7 +577,7 @@ class LogKinesis(LogObj):
                 self.__file_format = 'json'
                 yield record
                 continue
-            if self.config[self.logtype]['file_format'] == 'text':
+            if self.logconfig['file_format'] == 'text':
                 yield record['message']
                 continue
             record = json.loads(record['message'])
@@ -428,7 +586,7 @@ class LogKinesis(LogObj):
             if all(k in record for k in cwl_keys):
                 record = record['detail']
                 # 1つのJSNにログが複数ある場合 eg) securityhub
-                delimiter = self.config[self.logtype]['json_delimiter']
+                delimiter = self.logconfig['json_delimiter']
                 if delimiter:
                     for each_event in record[delimiter]:
                         yield each_event
@@ -448,18 +606,67 @@ class LogKinesis(LogObj):
         if self.__file_format:
             return self.__file_format
         else:
-            return self.config[self.logtype]['file_format']
+            return self.logconfig['file_format']
+
+
+class TimestampSpec:
+    """ logconfig からタイムスタンプの抽出方法を取り出して保持する。
+    ログ1行ごとではなく、ログタイプごとに一度だけ作成する
+    """
+    __slots__ = ('key', 'kind', 'format', 'tz')
+
+    def __init__(self, logconfig):
+        timestamp_key = logconfig['timestamp_key']
+        timestamp_format = logconfig['timestamp_format']
+        if 'timestamp' in logconfig and logconfig['timestamp']:
+            # this is depprecatd code of v1.5.2 and keep for compatibility
+            timestamp_list = logconfig['timestamp'].split(',')
+            timestamp_key = timestamp_list[0]
+            if len(timestamp_list) == 2:
+                timestamp_format = timestamp_list[1]
+            # フォーマットの指定がなければISO9601と仮定。
+        self.key = timestamp_key
+        self.format = timestamp_format
+        if 'epoch' in timestamp_format:
+            self.kind = 'epoch'
+        elif 'syslog' in timestamp_format:
+            self.kind = 'syslog'
+        elif 'iso8601' in timestamp_format:
+            self.kind = 'iso8601'
+        elif timestamp_format:
+            self.kind = 'strptime'
+        else:
+            self.kind = None
+        self.tz = timezone(timedelta(hours=float(logconfig['timestamp_tz'])))
+
+
+class EcsSpec:
+    """ logconfig の json_to_text と ecs のフィールド対応を分割して保持する。
+    ログ1行ごとではなく、ログタイプごとに一度だけ作成する
+    """
+    __slots__ = ('multifield_keys', 'ecs_keys')
+
+    def __init__(self, logconfig):
+        self.multifield_keys = [
+            (multifield_key, parse_xkeys_list(multifield_key))
+            for multifield_key in logconfig['json_to_text'].split()]
+        # (ECSのフィールド名, 元のフィールドのkey, IPアドレスか)
+        self.ecs_keys = [
+            (ecs_key, parse_xkeys_list(logconfig[ecs_key]), '.ip' in ecs_key)
+            for ecs_key in logconfig['ecs'].split()]
 
 
 class LogParser:
     """ 生ファイルから、ファイルタイプ毎に、タイムスタンプの抜き出し、
     テキストなら名前付き正規化による抽出、エンリッチ(geoipなどの付与)、
     フィールドのECSへの統一、最後にJSON化、する
+    1つのログファイルのログは、batch で同じインスタンスを使って処理する
     """
     def __init__(self, logdata, logtype, logconfig, msgformat=None,
                  logformat=None, header=None, s3bucket=None, s3key=None,
                  loggroup=None, logstream=None, accountid=None, region=None,
-                 log_pattern_prog=None, sf_module=None, *args, **kwargs):
+                 log_pattern_prog=None, sf_module=None, timestamp_spec=None,
+                 header_fields=None, ecs_spec=None, *args, **kwargs):
         self.msgformat = msgformat
         self.logdata = logdata
         self.logtype = logtype
@@ -472,9 +679,46 @@ class LogParser:
         self.accountid = accountid
         self.region = region
         self.log_pattern_prog = log_pattern_prog
+        if timestamp_spec is None:
+            timestamp_spec = TimestampSpec(logconfig)
+        self.timestamp_spec = timestamp_spec
+        if ecs_spec is None:
+            ecs_spec = EcsSpec(logconfig)
+        self.ecs_spec = ecs_spec
         self.header = header
-        self.__logdata_dict = self.logdata_to_dict()
+        if header_fields is None and header:
+            header_fields = get_header_fields(header)
+        self.header_fields = header_fields
         self.sf_module = sf_module
+        if logdata is not None:
+            self.set_logdata(logdata)
+
+    def set_logdata(self, logdata):
+        """ 処理するログを入れ替える """
+        self.logdata = logdata
+        self.__logdata_dict = self.logdata_to_dict()
+
+    def batch(self, logdata_list, ignore_list):
+        """ ログファイルのログを1つずつ処理して、
+        インデックス名、ID、JSON化したログを返す
+        """
+        for logdata in logdata_list:
+            self.set_logdata(logdata)
+            # 自分自身のログを無視する。ESにはロードしない。
+            if self.check_ignored_log(ignore_list):
+                continue
+            # idなどの共通的なフィールドを追加する
+            self.add_basic_field()
+            # 同じフィールド名で複数タイプがあるとESにロードするときにエラーになるので
+            # 該当フィールドだけテキスト化する
+            self.clean_multi_type_field()
+            # フィールドをECSにマッピングして正規化する
+            self.transform_to_ecs()
+            # 一部のフィールドを修正する
+            self.transform_by_script()
+            # ログにgeoipなどの情報をエンリッチ
+            self.enrich()
+            yield self.indexname, self.index_id, self.json
 
     def logdata_to_dict(self):
         logdata_dict = {}
@@ -482,8 +726,7 @@ class LogParser:
             # CWLでJSON化してる場合
             logdata_dict = self.logdata['extractedFields']
         elif self.logformat in 'csv':
-            logdata_dict = dict(zip(self.header.split(), self.logdata.split()))
-            conv_key(logdata_dict)
+            logdata_dict = dict(zip(self.header_fields, self.logdata.split()))
         elif self.logformat in 'json':
             logdata_dict = self.logdata
         elif self.logformat in 'text':
@@ -516,6 +759,7 @@ class LogParser:
         if 'kinesis' in self.msgformat and 'extractedFields' in self.logdata:
             basic_dict['@message'] = self.logdata['message']
         elif self.logformat in 'json':
+            # @id が変わらないように @message は標準ライブラリで文字列にする
             basic_dict['@message'] = str(json.dumps(self.logdata))
         else:
             basic_dict['@message'] = str(self.logdata)
@@ -529,7 +773,7 @@ class LogParser:
             basic_dict['@id'] = self.__logdata_dict[self.logconfig['doc_id']]
         else:
             basic_dict['@id'] = hashlib.md5(
-                str(basic_dict['@message']).encode('utf-8')).hexdigest()
+                basic_dict['@message'].encode('utf-8')).hexdigest()
         if self.loggroup:
             basic_dict['@log_group'] = self.loggroup
             basic_dict['@log_stream'] = self.logstream
@@ -540,9 +784,8 @@ class LogParser:
 
     def clean_multi_type_field(self):
         clean_multi_type_dict = {}
-        multifield_keys = self.logconfig['json_to_text'].split()
-        for multifield_key in multifield_keys:
-            v = get_value_from_dict(self.__logdata_dict, multifield_key)
+        for multifield_key, paths in self.ecs_spec.multifield_keys:
+            v = get_value_by_paths(self.__logdata_dict, paths)
             if v:
                 # json obj in json obj
                 if isinstance(v, int):
@@ -558,23 +801,18 @@ class LogParser:
         ecs_dict = {'ecs': {'version': self.logconfig['ecs_version']}}
         if self.logconfig['cloud_provider']:
             ecs_dict['cloud'] = {'provider': self.logconfig['cloud_provider']}
-        ecs_keys = self.logconfig['ecs'].split()
-        for ecs_key in ecs_keys:
-            original_keys = self.logconfig[ecs_key]
-            v = get_value_from_dict(self.__logdata_dict, original_keys)
+        for ecs_key, paths, is_ip_field in self.ecs_spec.ecs_keys:
+            v = get_value_by_paths(self.__logdata_dict, paths)
             if v:
                 # disable after ecs1.6.0
                 # 特定のECSは全部小文字にする
                 # lower_keys = ('http.request.method')
                 # if ecs_key in lower_keys:
                 #    v = v.lower()
-                new_ecs_dict = put_value_into_dict(ecs_key, v)
-                if '.ip' in ecs_key:
+                if is_ip_field and not is_ip(v):
                     # IPアドレスの場合は、validation
-                    try:
-                        ipaddress.ip_address(v)
-                    except ValueError:
-                        continue
+                    continue
+                new_ecs_dict = put_value_into_dict(ecs_key, v)
                 merge(ecs_dict, new_ecs_dict)
         if 'cloud' in ecs_dict:
             if 'account' in ecs_dict['cloud'] \
@@ -611,10 +849,15 @@ class LogParser:
                 ipaddr = self.__logdata_dict[geoip_ecs]['ip']
             except KeyError:
                 continue
+            # 返値はキャッシュされて共有される。ログに付与した後に del_none や
+            # sf_ スクリプトで変更されてもキャッシュに影響しないようにコピーする
             geoip = get_geo_city(ipaddr)
             if geoip:
+                geoip = dict(geoip, location=dict(geoip['location']))
                 enrich_dict[geoip_ecs] = {'geo': geoip}
             asn = get_geo_asn(ipaddr)
+            if asn:
+                asn = dict(asn, organization=dict(asn['organization']))
             if geoip and asn:
                 enrich_dict[geoip_ecs].update({'as': asn})
             elif asn:
@@ -631,86 +874,74 @@ class LogParser:
             return self.__logdata_dict['@id']
 
     def get_timestamp(self):
-        if 'timestamp' in self.logconfig and self.logconfig['timestamp']:
-            # this is depprecatd code of v1.5.2 and keep for compatibility
-            timestamp_list = self.logconfig['timestamp'].split(',')
-            self.logconfig['timestamp_key'] = timestamp_list[0]
-            if len(timestamp_list) == 2:
-                self.logconfig['timestamp_format'] = timestamp_list[1]
-            # フォーマットの指定がなければISO9601と仮定。
-        if self.logconfig['timestamp_key']:
-            # new code from ver 1.6.0
-            timestamp_key = self.logconfig['timestamp_key']
-            timestamp_format = self.logconfig['timestamp_format']
-            timestamp_tz = float(self.logconfig['timestamp_tz'])
-            TZ = timezone(timedelta(hours=timestamp_tz))
+        ts = self.timestamp_spec
+        if not ts.key:
+            return datetime.now(timezone.utc)
+        timestr = self.__logdata_dict[ts.key]
+        if ts.kind == 'epoch':
+            epoch = float(timestr)
+            if epoch > 1000000000000:
+                # milli epoch
+                dt = datetime.fromtimestamp(epoch/1000, tz=ts.tz)
+            else:
+                # normal epoch
+                dt = datetime.fromtimestamp(epoch, tz=ts.tz)
+        elif ts.kind == 'iso8601':
             # 末尾がZはPythonでは対応していないのでカットしてTZを付与
+            if timestr.endswith('Z'):
+                timestr = timestr[:-1] + '+00:00'
             try:
-                timestr = self.__logdata_dict[timestamp_key].replace(
-                    'Z', '+00:00')
-            except AttributeError:
-                # int such as epoch
-                timestr = self.__logdata_dict[timestamp_key]
-            if 'epoch' in timestamp_format:
-                epoch = float(timestr)
-                if epoch > 1000000000000:
-                    # milli epoch
-                    dt = datetime.fromtimestamp(epoch/1000, tz=TZ)
-                else:
-                    # normal epoch
-                    dt = datetime.fromtimestamp(epoch, tz=TZ)
-            elif 'syslog' in timestamp_format:
-                # timezoneを考慮して、12時間を早めた現在時刻を基準とする
-                now = datetime.now(timezone.utc) + TD_OFFSET12
-                m = RE_SYSLOG_FORMAT.match(timestr)
-                try:
-                    # コンマ以下の秒があったら
-                    microsec = int(m.group(7).ljust(6, '0'))
-                except AttributeError:
-                    microsec = 0
-                try:
-                    dt = datetime(
-                        year=now.year, month=MONTH_TO_INT[m.group(1)],
-                        day=int(m.group(2)), hour=int(m.group(3)),
-                        minute=int(m.group(4)), second=int(m.group(5)),
-                        microsecond=microsec, tzinfo=TZ)
-                except ValueError:
-                    # うるう年対策
-                    dt = datetime(
-                        year=now.year-1, month=MONTH_TO_INT[m.group(1)],
-                        day=int(m.group(2)), hour=int(m.group(3)),
-                        minute=int(m.group(4)), second=int(m.group(5)),
-                        microsecond=microsec, tzinfo=TZ)
-                if dt > now:
-                    # syslog timestamp が未来。マイナス1年の補正が必要
-                    # 1年以上古いログの補正はできない
-                    dt = dt.replace(year=now.year-1)
-                else:
-                    # syslog timestamp が過去であり適切。処理なし
-                    pass
-            elif 'iso8601' in timestamp_format:
-                try:
-                    dt = datetime.fromisoformat(timestr)
-                except ValueError as err:
-                    raise ValueError(
-                        'ERROR: timestamp {0} is not ISO9601. See details {1}'
-                        ''.format(self.logconfig['timestamp_key'], err))
-                if not dt.tzinfo:
-                    dt = dt.replace(tzinfo=TZ)
-            elif timestamp_format:
-                try:
-                    dt = datetime.strptime(timestr, timestamp_format)
-                except ValueError as err:
-                    raise ValueError(
-                        'ERROR: timestamp key {0} is wrong. See details {1}'
-                        ''.format(self.logconfig['timestamp_key'], err))
-                if not dt.tzinfo:
-                    dt = dt.replace(tzinfo=TZ)
+                dt = datetime.fromisoformat(timestr)
+            except ValueError as err:
+                raise ValueError(
+                    'ERROR: timestamp {0} is not ISO9601. See details {1}'
+                    ''.format(ts.key, err))
+            if not dt.tzinfo:
+                dt = dt.replace(tzinfo=ts.tz)
+        elif ts.kind == 'syslog':
+            # timezoneを考慮して、12時間を早めた現在時刻を基準とする
+            now = datetime.now(timezone.utc) + TD_OFFSET12
+            # group() を何度も呼ばないように一度に取り出す
+            mon, day, hour, minute, sec, _, frac = RE_SYSLOG_FORMAT.match(
+                timestr).groups()
+            month, day = MONTH_TO_INT[mon], int(day)
+            hour, minute, sec = int(hour), int(minute), int(sec)
+            if frac:
+                # コンマ以下の秒があったら
+                microsec = int((frac + '00000')[:6])
             else:
+                microsec = 0
+            try:
+                dt = datetime(
+                    year=now.year, month=month, day=day, hour=hour,
+                    minute=minute, second=sec, microsecond=microsec,
+                    tzinfo=ts.tz)
+            except ValueError:
+                # うるう年対策
+                dt = datetime(
+                    year=now.year-1, month=month, day=day, hour=hour,
+                    minute=minute, second=sec, microsecond=microsec,
+                    tzinfo=ts.tz)
+            if dt > now:
+                # syslog timestamp が未来。マイナス1年の補正が必要
+                # 1年以上古いログの補正はできない
+                dt = dt.replace(year=now.year-1)
+            else:
+                # syslog timestamp が過去であり適切。処理なし
+                pass
+        elif ts.kind == 'strptime':
+            try:
+                dt = datetime.strptime(
+                    timestr.replace('Z', '+00:00'), ts.format)
+            except ValueError as err:
                 raise ValueError(
-                    "ERROR: There is no timestamp format. It's necessary")
+                    'ERROR: timestamp key {0} is wrong. See details {1}'
+                    ''.format(ts.key, err))
+            if not dt.tzinfo:
+                dt = dt.replace(tzinfo=ts.tz)
         else:
-            dt = datetime.now(timezone.utc)
+            raise ValueError(
+                "ERROR: There is no timestamp format. It's necessary")
         return dt
 
     @property
@@ -743,17 +974,28 @@ class LogParser:
             return indexname + index_dt.strftime('-%Y')
 
     def del_none(self, d):
-        """ 値のないキーを削除する。削除しないとESへのLoad時にエラーとなる """
-        for key, value in list(d.items()):
-            if isinstance(value, dict) and len(value) == 0:
-                del d[key]
-            elif isinstance(value, str) and (value in ('', '-', 'null')):
-                del d[key]
-            elif isinstance(value, dict):
-                self.del_none(value)
+        """ 値のないキーを削除する。削除しないとESへのLoad時にエラーとなる
+        子を先に処理するので、削除により空になった親の辞書も1回で削除される
+        """
+        stack = [(None, None, d, False)]
+        while stack:
+            parent, key, node, visited = stack.pop()
+            if visited:
+                if not node and parent is not None:
+                    del parent[key]
+                continue
+            stack.append((parent, key, node, True))
+            for k, v in list(node.items()):
+                if isinstance(v, dict):
+                    if v:
+                        stack.append((node, k, v, False))
+                    else:
+                        del node[k]
+                elif isinstance(v, str) and v in NULL_VALUES:
+                    del node[k]
         return d
 
     @property
     def json(self):
-        self.__logdata_dict = self.del_none(self.del_none(self.__logdata_dict))
-        return json.dumps(self.__logdata_dict)
+        self.__logdata_dict = self.del_none(self.__logdata_dict)
+        return json_dumps(self.__logdata_dict)